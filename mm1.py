@@ -1,23 +1,38 @@
 """
-Usage: python mm1.py [LAMBDA=1.0 MU=2.0 LIMIT_SWITCH=0 LIMIT_VALUE=10000 FIGURE_SAVE=1]
+Usage: python mm1.py [LAMBDA=1.0 MU=2.0 LIMIT_SWITCH=0 LIMIT_VALUE=10000 FIGURE_SAVE=1 REPLICATIONS=1]
 
 The program simulates an M|M|1 queueing system with arrival rate LAMBDA and departure rate MU. 
 LIMIT_SWITCH=0 will allow defining the runtime LIMIT_VALUE in time units; LIMIT_SWITCH=1 will 
 define the runtime LIMIT_VALUE in departures. Setting FIGURE_SAVE will result in plots of a 
 sample path of queue length and of estimators average queue length and average system time being 
-generated and saved to samplepath.png and estimators.png
+generated and saved to samplepath.png and estimators.png. Setting REPLICATIONS above 1 instead runs
+that many independent replications in parallel processes and reports the mean and standard error
+of the two estimators, without plots.
+
+The event loop is JIT-compiled when Numba is installed. Building the Cython extension with
+python setup.py build_ext --inplace replaces it with the compiled loop in mm1_core.pyx.
 """
 import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
-import heapq
+
+try:
+	from numba import njit
+	JIT = True
+except ImportError:
+	JIT = False
+	def njit(*args, **kwargs):
+		"""Stand-in for numba.njit when Numba is not installed; leaves the function as is"""
+		return lambda function: function
 
 LAMBDA = 1.0
 MU = 2.0
 LIMIT_SWITCH = 0
 LIMIT_VALUE = 10000
 FIGURE_SAVE = 1
-
+REPLICATIONS = 1
 
 if len(sys.argv) > 4:
 	LAMBDA = float(sys.argv[1])
@@ -30,99 +45,215 @@ if len(sys.argv) > 4:
 		LIMIT_VALUE = int(sys.argv[4])
 	if len(sys.argv) > 5:
 		FIGURE_SAVE = int(sys.argv[5])
+	if len(sys.argv) > 6:
+		REPLICATIONS = int(sys.argv[6])
 
 rho = LAMBDA/MU
 
-rates = {'a':LAMBDA, 'd':MU}
-infeasibleEvents = {'all':['INIT'], 0:['d']}
-feasibleEvents = {'all':['a', 'd']}
+A = 0
+D = 1
+BATCH = 1 << 16
 
-QUEUE = 0
-EVENTHEAP = [(0, 'INIT'),]
+rng = np.random.default_rng()
 
-arrivals = []
-departures = []
-
-def newLifetime(event):
-	"""Generate a new event's lifetime, with the Poisson parameter specified in the rates map"""
-	return -1/rates[event]*np.log(1 - np.random.rand())
+@njit(cache=True)
+def newLifetime(event, rates, rng, lifetimes, cursors):
+	"""Generate a new event's lifetime, with the Poisson parameter of event code event in rates.
+		Compiled this is a scalar draw from rng; in plain Python it comes from _blockLifetime.
+	"""
+	if (JIT):
+		return rng.exponential(1.0/rates[event])
+	return _blockLifetime(event, rates, rng, lifetimes, cursors)
 
-def updateState(event, queues):
-	"""Update the queue length as a function of current state and triggering event.
-		Also updates the array of queue lengths.
+@njit(cache=True)
+def _blockLifetime(event, rates, rng, lifetimes, cursors):
+	"""Hand out the next lifetime of event code event from lifetimes, which holds blocks of BATCH
+		pre-drawn lifetimes per event with the position in each block kept in cursors, drawing a
+		fresh block from rng once one is used up. Used without Numba, where each call to rng
+		costs a NumPy dispatch.
 	"""
-	global QUEUE
-	QUEUE += (event[1] == 'a') - (event[1] == 'd')
-	queues.append(QUEUE)
+	if (cursors[event] == BATCH):
+		lifetimes[event, :] = rng.exponential(1.0/rates[event], BATCH)
+		cursors[event] = 0
+	lifetime = lifetimes[event, cursors[event]]
+	cursors[event] += 1
+	return lifetime
 
-def updateFeasibleEvents(outgoing_event, times):
-	""" Update the scheduled event list given the current queue length and the event (with lifetime)
-		of the event that triggered the current state. Also updates the time array times.
+class State(namedtuple('State', ['Q', 't', 't_a', 't_d', 'u', 'arrivalCount', 'departureCount',
+		'maxQ'])):
+	"""State of the queue at the end of a run: the queue length Q, the clock t, the absolute
+		deadlines t_a and t_d of the next arrival and departure (t_d = inf while the queue is
+		empty, as a departure is then infeasible), the time integral u of the queue length, the
+		event counters and the largest recorded queue length maxQ.
 	"""
-	global EVENTHEAP
-	global arrivals
-	global departures
-	global feasibleEvents
-	global infeasibleEvents
-	try:
-		a = feasibleEvents[QUEUE]
-	except:
-		feasibleEvents[QUEUE] = []
-	try:
-		a = infeasibleEvents[QUEUE]
-	except:
-		infeasibleEvents[QUEUE] = []
-
-	EVENTHEAP = [(time - outgoing_event[0], event) for (time, event) in EVENTHEAP if event not in infeasibleEvents[QUEUE]]
-	residualEvents = [event for (time, event) in EVENTHEAP]
-
-	for event in ((set(feasibleEvents[QUEUE]).union(feasibleEvents['all'])) - set(residualEvents)) - (set(infeasibleEvents[QUEUE]).union(infeasibleEvents['all'])):
-		heapq.heappush(EVENTHEAP, (newLifetime(event), event))
-	if (times == []):
-		times.append(outgoing_event[0])
-	else:
-		times.append(times[-1] + outgoing_event[0])
-		if (outgoing_event[1] == 'a'):
-			arrivals.append(times[-1])
-		else:
-			departures.append(times[-1])
+	__slots__ = ()
 
-def runSimulation():
-	"""Updates the system until the maximum time or number of departures is reached,
-		and returns the array of times at which events occurred, the array of the queue length
-		at those times, the average queue length, and the average system time
+@njit(cache=True)
+def _grow(array):
+	"""Return a copy of array with twice the capacity, preserving its contents"""
+	grown = np.empty(2*array.shape[0], array.dtype)
+	grown[:array.shape[0]] = array
+	return grown
+
+@njit(cache=True)
+def _simulate(rng, lam, mu, limit_switch, limit_value, record, capacity, queueDtype):
+	"""Run the event loop with integer-coded events (A=0 arrival, D=1 departure) from an empty
+		queue until the limit is reached. Only if record is set are the event times, queue
+		lengths (as queueDtype) and arrival indicators stored, in arrays preallocated to
+		capacity entries and grown only if a run outlasts that estimate. Returns those arrays
+		trimmed to the number of recorded events (a single initial entry when not recording)
+		and a plain tuple of the fields of the final State, whose maxQ lets the caller check
+		that the recorded queue lengths fit queueDtype.
 	"""
+	if (not record):
+		capacity = 1
+	times = np.empty(capacity)
+	queues = np.empty(capacity, queueDtype)
+	arrivals = np.empty(capacity, np.int8)
+	times[0] = 0.0
+	queues[0] = 0
+	arrivals[0] = 0
+	n = 1
+
+	rates = np.array([lam, mu])
+	# The lifetime blocks are only read by _blockLifetime, so compiled runs allocate none
+	lifetimes = np.empty((0 if JIT else 2, BATCH))
+	cursors = np.full(2, BATCH)
+	t_a = newLifetime(A, rates, rng, lifetimes, cursors)
+	t_d = np.inf
+	Q = 0
+	t = 0.0
+	u = 0.0
+	arrivalCount = 0
 	departureCount = 0
-	times = []
-	queues = []
-	arrivalCountArray = [0]
-	while (True):	
-		new_event = heapq.heappop(EVENTHEAP)
-		if (new_event[1] == 'd'):
-			departureCount += 1
-			arrivalCountArray.append(0)
-		elif (new_event[1] == 'a'):
-			arrivalCountArray.append(1)
-		updateState(new_event, queues)
-		updateFeasibleEvents(new_event, times)
+	maxQ = 0
+	while (True):
+		event = int(t_d < t_a)
+		t_next = min(t_a, t_d)
+		u += Q*(t_next - t)
+		t = t_next
+		Q += 1 - 2*event
+		arrivalCount += 1 - event
+		departureCount += event
+		if (event == A):
+			t_a = t + newLifetime(A, rates, rng, lifetimes, cursors)
+			if (Q == 1):
+				t_d = t + newLifetime(D, rates, rng, lifetimes, cursors)
+		elif (Q > 0):
+			t_d = t + newLifetime(D, rates, rng, lifetimes, cursors)
+		else:
+			t_d = np.inf
 
-		if (LIMIT_SWITCH):
-			if (departureCount >= LIMIT_VALUE):
+		if (record):
+			if (n == times.shape[0]):
+				times = _grow(times)
+				queues = _grow(queues)
+				arrivals = _grow(arrivals)
+			times[n] = t
+			queues[n] = Q
+			arrivals[n] = 1 - event
+			n += 1
+			if (Q > maxQ):
+				maxQ = Q
+
+		if (limit_switch):
+			if (departureCount >= limit_value):
 				break
 		else:
-			if (times[-1] >= LIMIT_VALUE):
+			if (t >= limit_value):
 				break
 
-	tarray = np.array(times)
-	qarray = np.array(queues)
-	q_substantive = qarray[:-1]
-	difft = np.diff(tarray)
-	u = np.sum(q_substantive*difft)
-	L = u/tarray[-1]
-	S = u/len(arrivals)
+	return times[:n], queues[:n], arrivals[:n], (Q, t, t_a, t_d, u, arrivalCount,
+		departureCount, maxQ)
+
+# Version of the _simulate signature and return values that a built mm1_core must match
+CORE_VERSION = 3
+
+try:
+	import mm1_core
+except ImportError:
+	mm1_core = None
+
+# Prefer the compiled loop from mm1_core.pyx when it has been built (see setup.py), unless
+# the build is stale and its simulate() no longer matches _simulate
+if (getattr(mm1_core, 'CORE_VERSION', None) == CORE_VERSION):
+	_simulate = mm1_core.simulate
+
+@njit(cache=True)
+def _cumulativeTimeIntegral(times, queues, out):
+	"""Write the running integral of the queue length up to each event after the first into out"""
+	u = 0.0
+	for i in range(times.shape[0] - 1):
+		u += queues[i]*(times[i + 1] - times[i])
+		out[i] = u
+	return out
+
+def eventCapacity(lam, mu, limit_switch, limit_value):
+	"""Estimate an upper bound on the number of events a run will record: departures occur at
+		rate min(lambda, mu) in the long run, so a run of limit_value time units sees about
+		limit_value*(lambda + min(lambda, mu)) events, and a run of limit_value departures
+		about limit_value*(1 + max(rho, 1)). A 10% margin absorbs the fluctuations.
+	"""
+	if (limit_switch):
+		expected = limit_value*(1 + max(lam/mu, 1.0))
+	else:
+		expected = limit_value*(lam + min(lam, mu))
+	return int(1.1*expected) + 1024
+
+def queueDtype(lam, mu):
+	"""Return the integer type for recorded queue lengths. int16 is used only for rho <= 0.99,
+		where the stationary probability rho**32768 of exceeding its range is below 1e-142;
+		closer to or above rho = 1 the queue can reach that range on a long run, so int32 is
+		used. runSimulation still checks the largest recorded length against the type.
+	"""
+	if (lam <= 0.99*mu):
+		return np.int16
+	return np.int32
+
+def runSimulation():
+	"""Updates the system until the maximum time or number of departures is reached,
+		and returns the array of times at which events occurred, the array of the queue length
+		at those times, the average queue length, and the average system time. The arrays
+		are only recorded when FIGURE_SAVE is set.
+	"""
+	tarray, qarray, arrivalCountArray, fields = _simulate(rng, LAMBDA, MU,
+		LIMIT_SWITCH, LIMIT_VALUE, FIGURE_SAVE, eventCapacity(LAMBDA, MU, LIMIT_SWITCH, LIMIT_VALUE),
+		queueDtype(LAMBDA, MU))
+	state = State(*fields)
+	if (state.maxQ > np.iinfo(qarray.dtype).max):
+		raise OverflowError("queue length %d does not fit the recorded %s queue lengths"%(
+			state.maxQ, qarray.dtype))
+	L = state.u/state.t
+	S = state.u/state.arrivalCount
 	return tarray, qarray, arrivalCountArray, L, S
 
+def _replicate(seed, lam, mu, limit_switch, limit_value):
+	"""Run one unrecorded replication with its own generator seeded from seed, returning L and S"""
+	_, _, _, fields = _simulate(np.random.default_rng(seed), lam, mu, limit_switch, limit_value,
+		0, 1, np.int16)
+	state = State(*fields)
+	return state.u/state.t, state.u/state.arrivalCount
+
+def runReplications(replications):
+	"""Run independent replications across processes, with seeds spawned from a common
+		SeedSequence so that their streams do not overlap, and return the arrays of the average
+		queue length and average system time of each replication
+	"""
+	seeds = np.random.SeedSequence().spawn(replications)
+	n = len(seeds)
+	with ProcessPoolExecutor() as executor:
+		results = list(executor.map(_replicate, seeds, [LAMBDA]*n, [MU]*n, [LIMIT_SWITCH]*n,
+			[LIMIT_VALUE]*n))
+	Ls, Ss = np.array(results).T
+	return Ls, Ss
+
 def main():
+	if (REPLICATIONS > 1):
+		Ls, Ss = runReplications(REPLICATIONS)
+		sqrtReplications = np.sqrt(REPLICATIONS)
+		print("lambda = %.1f,    mu = %.1f,    rho = %.4f,    %d replications\nAvg queue, Avg sys time (mean +/- standard error)\n%.6f +/- %.6f, %.6f +/- %.6f"%(LAMBDA, MU, rho, REPLICATIONS, Ls.mean(), Ls.std(ddof=1)/sqrtReplications, Ss.mean(), Ss.std(ddof=1)/sqrtReplications))
+		return
+
 	tarray, qarray, arrivalCountArray, L, S = runSimulation()
 
 	print("lambda = %.1f,    mu = %.1f,    rho = %.4f\nAvg queue, Avg sys time\n%.6f, %.6f"%(LAMBDA, MU, rho, L, S))
@@ -133,9 +264,12 @@ def main():
 		else:
 			runtimeLabel = 'Time'
 
-		uarray = np.cumsum(qarray[:-1]*np.diff(tarray))
-		qdiff = np.diff(qarray)
-		plt.bar(tarray, qarray, edgecolor="none")
+		uarray = _cumulativeTimeIntegral(tarray, qarray, np.empty(tarray.shape[0] - 1))
+		arrivalCounts = np.empty(tarray.shape[0] - 1, np.int32)
+		np.add.accumulate(arrivalCountArray[1:], dtype=np.int32, out=arrivalCounts)
+		plt.rcParams['path.simplify'] = True
+		plt.rcParams['path.simplify_threshold'] = 1.0
+		plt.fill_between(tarray, 0, qarray, step='post', linewidth=0)
 		plt.title("Sample path of queue length vs. %s"%runtimeLabel.lower())
 		plt.xlabel("%s"%runtimeLabel)
 		plt.ylabel("Queue length")
@@ -144,10 +278,10 @@ def main():
 		plt.close()
 
 		plt.figure()
-		plt.rc('text', usetex=True)
+		plt.rc('mathtext', fontset='cm')
 		plt.rc('font', family='serif')
 		plt.plot(tarray[1:], uarray/tarray[1:], label=r"$\bar x$")
-		plt.plot(tarray[1:], uarray/np.cumsum(arrivalCountArray[1:]), label=r"$\bar s$")
+		plt.plot(tarray[1:], uarray/arrivalCounts, label=r"$\bar s$")
 		plt.legend()
 		plt.title(r"Estimators $\bar x$ and $\bar s$ as functions of %s"%runtimeLabel.lower())
 		plt.xlabel("%s"%runtimeLabel)
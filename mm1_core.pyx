@@ -0,0 +1,131 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled event loop for mm1.py. Build in place with: python setup.py build_ext --inplace
+
+simulate() mirrors mm1._simulate and is picked up by mm1.py in its place when this
+extension has been built, avoiding Numba's JIT compilation on the first run. mm1.py only does
+so when CORE_VERSION matches its own, so bump both whenever the signature or return values
+of simulate() change.
+"""
+from libc.math cimport INFINITY
+import numpy as np
+
+CORE_VERSION = 3
+
+cdef enum:
+	BATCH = 1 << 16
+
+cdef class _State:
+	"""State of the queue during the event loop, with the same fields as mm1.State. Its
+		newLifetime and fire are cdef methods, so they can only be called from Cython.
+	"""
+	cdef public long long Q
+	cdef public double t
+	cdef public double t_a
+	cdef public double t_d
+	cdef public double u
+	cdef public long long arrivalCount
+	cdef public long long departureCount
+	cdef public long long maxQ
+	cdef double rates[2]
+	cdef object blocks
+	cdef double[:, ::1] lifetimes
+	cdef Py_ssize_t cursors[2]
+
+	def __init__(self, rng, double lam, double mu):
+		self.Q = 0
+		self.t = 0.0
+		self.u = 0.0
+		self.arrivalCount = 0
+		self.departureCount = 0
+		self.maxQ = 0
+		self.rates[0] = lam
+		self.rates[1] = mu
+		self.blocks = np.empty((2, BATCH))
+		self.lifetimes = self.blocks
+		self.cursors[0] = BATCH
+		self.cursors[1] = BATCH
+		self.t_a = self.newLifetime(0, rng)
+		self.t_d = INFINITY
+
+	cdef inline double newLifetime(self, int event, rng):
+		if (self.cursors[event] == BATCH):
+			self.blocks[event] = rng.exponential(1.0/self.rates[event], BATCH)
+			self.cursors[event] = 0
+		self.cursors[event] += 1
+		return self.lifetimes[event, self.cursors[event] - 1]
+
+	cdef inline int fire(self, rng):
+		cdef int event = self.t_d < self.t_a
+		cdef double t = self.t_d if event else self.t_a
+		self.u += self.Q*(t - self.t)
+		self.t = t
+		self.Q += 1 - 2*event
+		self.arrivalCount += 1 - event
+		self.departureCount += event
+		if (event == 0):
+			self.t_a = t + self.newLifetime(0, rng)
+			if (self.Q == 1):
+				self.t_d = t + self.newLifetime(1, rng)
+		elif (self.Q > 0):
+			self.t_d = t + self.newLifetime(1, rng)
+		else:
+			self.t_d = INFINITY
+		return event
+
+def _grow(array):
+	"""Return a copy of array with twice the capacity, preserving its contents"""
+	grown = np.empty(2*array.shape[0], array.dtype)
+	grown[:array.shape[0]] = array
+	return grown
+
+ctypedef fused queue_t:
+	short
+	int
+
+def _run(_State state, rng, int limit_switch, double limit_value, int record, double[::1] times,
+		queue_t[::1] queues, signed char[::1] arrivals):
+	"""Fire events on state until the limit is reached, recording the sample path if record is set"""
+	cdef Py_ssize_t n = 1
+	cdef int event
+	while (True):
+		event = state.fire(rng)
+
+		if (record):
+			if (n == times.shape[0]):
+				times = _grow(np.asarray(times))
+				queues = _grow(np.asarray(queues))
+				arrivals = _grow(np.asarray(arrivals))
+			times[n] = state.t
+			queues[n] = state.Q
+			arrivals[n] = 1 - event
+			n += 1
+			if (state.Q > state.maxQ):
+				state.maxQ = state.Q
+
+		if (limit_switch):
+			if (state.departureCount >= limit_value):
+				break
+		else:
+			if (state.t >= limit_value):
+				break
+
+	return np.asarray(times)[:n], np.asarray(queues)[:n], np.asarray(arrivals)[:n]
+
+def simulate(rng, double lam, double mu, int limit_switch, double limit_value, int record,
+		Py_ssize_t capacity, queueDtype):
+	"""Run the event loop; takes the same arguments and returns the same values as mm1._simulate"""
+	if (not record):
+		capacity = 1
+	times = np.empty(capacity)
+	queues = np.empty(capacity, queueDtype)
+	arrivals = np.empty(capacity, np.int8)
+	times[0] = 0.0
+	queues[0] = 0
+	arrivals[0] = 0
+
+	cdef _State state = _State(rng, lam, mu)
+	times, queues, arrivals = _run(state, rng, limit_switch, limit_value, record, times, queues,
+		arrivals)
+	return times, queues, arrivals, (state.Q, state.t, state.t_a, state.t_d, state.u,
+		state.arrivalCount, state.departureCount, state.maxQ)
@@ -0,0 +1,12 @@
+"""
+Builds the optional compiled event loop used by mm1.py:
+
+	python setup.py build_ext --inplace
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+	name='PyMM1',
+	ext_modules=cythonize('mm1_core.pyx'),
+)